@@ -23,6 +23,7 @@ class ExponentialBackoff:
         self._initial = True
         self._min = min_
         self._max = max_
+        self._wake_event = trio.Event()
 
     def __repr__(self):
         return '<ExponentialBackoff value={}>'.format(self._backoff)
@@ -39,9 +40,16 @@ class ExponentialBackoff:
             self._initial = False
         else:
             backoff = self._backoff
-            await trio.sleep(backoff)
+            with trio.move_on_after(backoff):
+                await self._wake_event.wait()
+            self._wake_event = trio.Event()
         return backoff
 
+    def wake(self):
+        ''' End the current delay early. If the loop is not currently waiting,
+        then the next delay is skipped instead. '''
+        self._wake_event.set()
+
     def increase(self):
         ''' Double the current backoff, but not if it would exceed this
         instance's max value. '''
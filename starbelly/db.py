@@ -1089,16 +1089,21 @@ class SubscriptionDb:
             return {
                 'join': r.branch(
                     item.has_fields('body_id'),
-                    r.table('response_body').get(item['body_id']),
+                    r.table('response_body').get(item['body_id'])
+                     .pluck('body', 'is_compressed'),
                     None
                 )
             }
 
+        # Only fetch the fields that are sent to the client.
         query = (
             r.table('response')
              .order_by(index='job_sync')
              .between([job_id, starting_sequence],
                       [job_id, r.maxval], left_bound='open')
+             .pluck('body_id', 'completed_at', 'content_type', 'cost',
+                    'duration', 'exception', 'headers', 'is_success', 'job_id',
+                    'sequence', 'started_at', 'status_code', 'url', 'url_can')
              .merge(get_body)
         )
 
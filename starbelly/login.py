@@ -1,11 +1,13 @@
 import asyncio
-from functools import partial
+from functools import lru_cache
 import logging
 import random
+import threading
 
 import aiohttp
 import cchardet
 import formasaurus
+import lxml.etree
 import trio
 import trio_asyncio
 import w3lib.encoding
@@ -15,25 +17,80 @@ from .downloader import DownloadRequest
 
 
 logger = logging.getLogger(__name__)
-chardet = lambda s: cchardet.detect(s).get('encoding')
+CAPTCHA_POLL_BUDGET = 60.0
+CAPTCHA_POLL_MIN_DELAY = 2.0
+CAPTCHA_POLL_MAX_DELAY = 10.0
+LOGIN_FIELD_SLOTS = {
+    'username': 0,
+    'username or email': 0,
+    'password': 1,
+    'captcha': 2,
+}
+# w3lib only calls this when neither the Content-Type header nor the document
+# declares an encoding. The first few KB are plenty for detection.
+chardet = lambda s: cchardet.detect(s[:4096]).get('encoding')
+_form_classifier_lock = threading.Lock()
+_find_images = lxml.etree.XPath('.//img')
+_find_field = lxml.etree.XPath('.//*[@name=$name]')
+
+
+def extract_forms(html):
+    '''
+    Extract forms and their label probabilities from an HTML document.
+
+    This is a blocking call that should run in a worker thread. Formasaurus
+    already shares one model instance between calls; the lock only makes sure
+    that logins starting at the same time do not race to load it first.
+
+    :param str html:
+    :returns: A list of (form, meta) tuples.
+    :rtype: list
+    '''
+    with _form_classifier_lock:
+        classifier = formasaurus.classifiers.get_instance()
+    return classifier.extract_forms(html, proba=True)
 
 
-def get_captcha_image_element(form):
+@lru_cache(maxsize=32)
+def get_captcha_urls(service_url):
+    '''
+    Return the API endpoints for a CAPTCHA solving service.
+
+    There are only a handful of CAPTCHA solvers configured at any one time, so
+    the joined URLs are cached instead of rebuilt for every CAPTCHA.
+
+    :param str service_url: The solver's base URL.
+    :returns: (task URL, poll URL)
+    :rtype: tuple
+    '''
+    base_url = URL(service_url)
+    task_url = str(base_url.join(URL('createTask')))
+    poll_url = str(base_url.join(URL('getTaskResult')))
+    return task_url, poll_url
+
+
+def get_captcha_image_element(form, captcha_field=None):
     '''
     Return the <img> element in an lxml form that contains the CAPTCHA.
 
-    NOTE: This assumes the first image in the form is the CAPTCHA image. If
-    a form has multiple images, maybe use the etree .sourceline attribute to
-    figure out which image is closer to the CAPTCHA input? Or crawl through
-    the element tree to find the image?
+    If the form has multiple images and ``captcha_field`` is given, then the
+    image closest to the CAPTCHA input (by source line) is assumed to be the
+    CAPTCHA. Otherwise the first image in the form is used.
 
     :param form: An lxml form element.
+    :param str captcha_field: The name of the CAPTCHA input field.
     :returns: An lxml image element.
     '''
-    img_el = form.find('.//img')
-    if img_el is None:
+    images = _find_images(form)
+    if not images:
         raise Exception('Cannot locate CAPTCHA image')
-    return img_el
+    if captcha_field is None or len(images) == 1:
+        return images[0]
+    fields = _find_field(form, name=captcha_field)
+    if not fields or fields[0].sourceline is None:
+        return images[0]
+    field_line = fields[0].sourceline
+    return min(images, key=lambda img: abs((img.sourceline or 0) - field_line))
 
 
 def select_login_fields(fields):
@@ -45,27 +102,17 @@ def select_login_fields(fields):
     :returns: (username field, password field, captcha field)
     :rtype: tuple
     '''
-    username_field = None
-    username_prob = 0
-    password_field = None
-    password_prob = 0
-    captcha_field = None
-    captcha_prob = 0
+    # Each slot holds (field name, probability) for username, password, and
+    # CAPTCHA, respectively.
+    selected = [(None, 0)] * 3
 
     for field_name, labels in fields.items():
         for label, prob in labels.items():
-            if label in ('username', 'username or email') \
-                and prob > username_prob:
-                username_field = field_name
-                username_prob = prob
-            elif label == 'password' and prob > password_prob:
-                password_field = field_name
-                password_prob = prob
-            elif label == 'captcha' and prob > captcha_prob:
-                captcha_field = field_name
-                captcha_prob = prob
+            slot = LOGIN_FIELD_SLOTS.get(label)
+            if slot is not None and prob > selected[slot][1]:
+                selected[slot] = (field_name, prob)
 
-    return username_field, password_field, captcha_field
+    return tuple(field_name for field_name, _ in selected)
 
 
 def select_login_form(forms):
@@ -77,18 +124,10 @@ def select_login_form(forms):
     :returns: (login form, login meta)
     :rtype: tuple
     '''
-    login_form = None
-    login_meta = None
-    login_prob = 0
-
-    for form, meta in forms:
-        for type_, prob in meta['form'].items():
-            if type_ == 'login' and prob > login_prob:
-                login_form = form
-                login_meta = meta
-                login_prob = prob
-
-    return login_form, login_meta
+    login_forms = ((form, meta) for form, meta in forms
+        if meta['form'].get('login', 0) > 0)
+    return max(login_forms, key=lambda fm: fm[1]['form']['login'],
+        default=(None, None))
 
 
 class LoginManager:
@@ -175,8 +214,7 @@ class LoginManager:
             auto_detect_fun=chardet
         )
 
-        forms = await trio.run_sync_in_worker_thread(partial(
-            formasaurus.extract_forms, html, proba=True))
+        forms = await trio.run_sync_in_worker_thread(extract_forms, html)
         form, meta = select_login_form(forms)
 
         if form is None:
@@ -195,7 +233,7 @@ class LoginManager:
                 raise Exception('CAPTCHA required for login url={} but there is'
                     ' no CAPTCHA solver available'.format(response.url))
 
-            img_el = get_captcha_image_element(form)
+            img_el = get_captcha_image_element(form, captcha_field)
             img_src = str(URL(response.url).join(URL(img_el.get('src'))))
             img_data = await self._download_captcha_image(img_src)
             captcha_text = await self._solve_captcha_asyncio(img_data)
@@ -215,8 +253,7 @@ class LoginManager:
         '''
         solver = self._policy.captcha_solver
         solution = None
-        task_url = str(URL(solver.service_url).join(URL('createTask')))
-        poll_url = str(URL(solver.service_url).join(URL('getTaskResult')))
+        task_url, poll_url = get_captcha_urls(solver.service_url)
 
         # This doesn't use the downloader object because this is a third party
         # and is not the subject of our crawl.
@@ -231,23 +268,30 @@ class LoginManager:
                 task_id = result['taskId']
                 logger.info('Sent image to CAPTCHA API task_id=%d', task_id)
 
-            # Poll for task completion. (Try 6 times.)
+            # Poll for task completion. Start polling soon, then back off
+            # gradually, and give up once the time budget is spent.
             solution = None
-            for attempt in range(6):
-                await asyncio.sleep(5)
+            loop = asyncio.get_event_loop()
+            deadline = loop.time() + CAPTCHA_POLL_BUDGET
+            delay = CAPTCHA_POLL_MIN_DELAY
+            attempt = 0
+            while solution is None and loop.time() < deadline:
+                await asyncio.sleep(min(delay, deadline - loop.time()))
+                delay = min(delay * 1.5, CAPTCHA_POLL_MAX_DELAY)
+                attempt += 1
                 command = {
                     'clientKey': solver.api_key,
                     'taskId': task_id,
                 }
                 logger.info('Polling for CAPTCHA solution task_id=%d,'
-                    ' attempt=%d', task_id, attempt+1)
+                    ' attempt=%d', task_id, attempt)
                 async with session.post(poll_url, json=command) as response:
                     result = await response.json()
                     if result['errorId'] != 0:
                         raise Exception('CAPTCHA API error {}'
                             .format(result['errorId']))
-                    solution = result['solution']['text']
-                    break
+                    if result.get('status') == 'ready':
+                        solution = result['solution']['text']
 
         if solution is None:
             raise Exception('CAPTCHA API never completed task')
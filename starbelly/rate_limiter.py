@@ -1,4 +1,3 @@
-from binascii import hexlify
 from collections import deque
 from dataclasses import dataclass
 import functools
@@ -60,7 +59,7 @@ class Expiry:
     def __repr__(self):
         ''' This repr is easier to read than the default. '''
         return 'Expiry(time={:0.3f}, token={})'.format(self.time,
-            hexlify(self.token).decode('ascii'))
+            self.token.hex())
 
 
 def get_domain_token(domain):
@@ -212,7 +211,7 @@ class RateLimiter:
         :param float delay: The delay between subsequent requests, in seconds.
         '''
         logger.debug('Set rate limit: token=%r delay=%f',
-            hexlify(token).decode('ascii'), delay)
+            token.hex(), delay)
         if token == GLOBAL_RATE_LIMIT_TOKEN:
             self._global_limit = delay
         else:
@@ -1,4 +1,5 @@
 from abc import ABCMeta
+from functools import lru_cache
 import gzip
 import itertools
 import logging
@@ -16,6 +17,35 @@ from .starbelly_pb2 import JobRunState, ServerMessage, SubscriptionClosed
 
 r = RethinkDB()
 logger = logging.getLogger(__name__)
+# The crawl sync reader only needs to stay a few items ahead of the sender to
+# start the next RethinkDB CONTINUE early; the cursor itself buffers a batch.
+# Each item in this channel holds a whole response body, so keep it small.
+SYNC_PREFETCH_SIZE = 2
+# Starting a worker thread costs more than decompressing a small body, so only
+# compressed bodies at least this large are decompressed in a thread.
+SYNC_DECOMPRESS_THREAD_SIZE = 256 * 1024
+# A few serialized messages are enough to overlap serializing with sending.
+# Each one also contains a whole response body.
+SYNC_SEND_BUFFER_SIZE = 4
+# Job run states are stored in lowercase (see starbelly.job.RunState), but
+# enum names are also accepted.
+RUN_STATE_VALUES = dict(JobRunState.items())
+RUN_STATE_VALUES.update((name.lower(), value)
+    for name, value in JobRunState.items())
+
+
+@lru_cache(maxsize=1024)
+def job_id_to_bytes(job_id):
+    '''
+    Convert a job ID string to bytes.
+
+    Subscriptions send the same handful of job IDs over and over, so the
+    conversion is cached rather than parsing a UUID for every event.
+
+    :param str job_id:
+    :rtype: bytes
+    '''
+    return UUID(job_id).bytes
 
 
 class SyncTokenError(Exception):
@@ -29,6 +59,7 @@ class SyncTokenInt(metaclass=ABCMeta):
     1 and the next 8 bytes contains the value.
     '''
     FORMAT = '=BQ'
+    STRUCT = struct.Struct(FORMAT)
     TOKEN_NUM = 1
 
     @classmethod
@@ -40,7 +71,7 @@ class SyncTokenInt(metaclass=ABCMeta):
         :rtype: int
         '''
         try:
-            type_, val = struct.unpack(cls.FORMAT, token)
+            type_, val = cls.STRUCT.unpack(token)
         except:
             raise SyncTokenError('Cannot decocde SyncTokenInt: {}'.format(
                 token))
@@ -57,7 +88,7 @@ class SyncTokenInt(metaclass=ABCMeta):
         :param int val:
         :rtype: bytes
         '''
-        return struct.pack(cls.FORMAT, cls.TOKEN_NUM, val)
+        return cls.STRUCT.pack(cls.TOKEN_NUM, val)
 
 
 class SubscriptionManager:
@@ -186,14 +217,19 @@ class CrawlSyncSubscription:
         self._job_id = job_id
         self._compression_ok = compression_ok
         self._job_state_recv = job_state_recv
-        self._current_sequence = 0
+        # The sequence number of the last item sent, which is also what the
+        # sync token stores. The next pass reads items after this one.
+        self._last_sequence = 0
         self._cancel_scope = None
         self._job_completed = None
+        self._backoff = ExponentialBackoff(max_=64)
+        self._job_id_bytes = UUID(job_id).bytes
+        self._item_message = ServerMessage()
 
         if sync_token:
-            self._current_sequence = SyncTokenInt.decode(sync_token)
-            logging.debug('%r Setting current sequence to %d', self,
-                self._current_sequence)
+            self._last_sequence = SyncTokenInt.decode(sync_token)
+            logger.debug('%r Setting last sequence to %d', self,
+                self._last_sequence)
 
     def __repr__(self):
         ''' For debugging purposes, put the subscription ID and part of the job
@@ -252,6 +288,9 @@ class CrawlSyncSubscription:
                 if job_state.run_state in FINISHED_STATES:
                     logger.debug('%r Job status: %s', self, job_state.run_state)
                     self._job_completed = True
+                # Any change in job state may mean there are new items to sync
+                # (or none ever will be), so poll the database right away.
+                self._backoff.wake()
 
     async def _run_sync(self):
         '''
@@ -259,14 +298,40 @@ class CrawlSyncSubscription:
 
         :returns: This function runs until the sync is complete.
         '''
-        backoff = ExponentialBackoff(max_=64)
+        # Messages are written to the websocket in a separate task, so that the
+        # next item is serialized while the current item is being sent.
+        message_send, message_recv = trio.open_memory_channel(
+            SYNC_SEND_BUFFER_SIZE)
+        async with trio.open_nursery() as sender_nursery:
+            sender_nursery.start_soon(self._send_messages_task, message_recv,
+                name='Sync Item Sender')
+            async with message_send:
+                await self._sync_items(message_send)
+
+    async def _sync_items(self, message_send):
+        '''
+        Read items from the database and send serialized item events to a
+        channel.
+
+        :param trio.SendChannel message_send:
+        :returns: This function runs until the sync is complete.
+        '''
+        backoff = self._backoff
         async for _ in backoff:
             item_count = 0
-            async for item in self._db.get_job_sync_items(self._job_id,
-                    self._current_sequence):
-                item_count += 1
-                await self._send_item(item)
-                self._current_sequence = item['sequence'] + 1
+            # Items are read from the database in a separate task, so that the
+            # next batch is fetched while the current batch is being sent.
+            item_send, item_recv = trio.open_memory_channel(
+                SYNC_PREFETCH_SIZE)
+            async with trio.open_nursery() as nursery:
+                nursery.start_soon(self._read_items_task, item_send,
+                    self._last_sequence, name='Sync Item Reader')
+                async for item in item_recv:
+                    item_count += 1
+                    await self._decompress_body(item)
+                    message = self._make_item_event(item)
+                    await message_send.send(message.SerializeToString())
+                    self._last_sequence = item['sequence']
 
             if item_count == 0:
                 if self._job_completed:
@@ -274,7 +339,55 @@ class CrawlSyncSubscription:
                 backoff.increase()
             else:
                 backoff.decrease()
-            logging.debug('backoff is now %s', backoff)
+            logger.debug('backoff is now %s', backoff)
+
+    async def _read_items_task(self, item_send, starting_sequence):
+        '''
+        Read items to sync from the database and send them to a channel.
+
+        :param trio.SendChannel item_send: The channel to send items to. It is
+            closed when there are no more items to read.
+        :param int starting_sequence: Read items with a sequence number greater
+            than this one.
+        '''
+        async with item_send:
+            async for item in self._db.get_job_sync_items(self._job_id,
+                    starting_sequence):
+                await item_send.send(item)
+
+    async def _decompress_body(self, item_doc):
+        '''
+        If the client does not accept compressed bodies, then decompress the
+        item's body in place.
+
+        This is done after the item leaves the prefetch channel, so that
+        buffered items still hold compressed bodies. Decompressing a large body
+        can take a while, so large bodies are decompressed in a worker thread
+        instead of blocking the event loop.
+
+        :param dict item_doc: A database document.
+        '''
+        if self._compression_ok or 'exception' in item_doc:
+            return
+        join = item_doc['join']
+        if join['is_compressed']:
+            if len(join['body']) >= SYNC_DECOMPRESS_THREAD_SIZE:
+                join['body'] = await trio.run_sync_in_worker_thread(
+                    gzip.decompress, join['body'])
+            else:
+                join['body'] = gzip.decompress(join['body'])
+            join['is_compressed'] = False
+
+    async def _send_messages_task(self, message_recv):
+        '''
+        Send serialized messages from a channel to the websocket.
+
+        :param trio.ReceiveChannel message_recv:
+        :returns: This function runs until the channel is closed.
+        '''
+        async with message_recv:
+            async for message_data in message_recv:
+                await self._websocket.send_message(message_data)
 
     async def _send_complete(self):
         ''' Send a subscription end event. '''
@@ -283,11 +396,19 @@ class CrawlSyncSubscription:
         message.event.subscription_closed.reason = SubscriptionClosed.COMPLETE
         await self._websocket.send_message(message.SerializeToString())
 
-    async def _send_item(self, item_doc):
-        ''' Send an item (download response) to the client. '''
+    def _make_item_event(self, item_doc):
+        '''
+        Make an event for an item (download response).
+
+        :param dict item_doc: A database document.
+        :rtype: starbelly_pb2.ServerMessage
+        '''
         logger.debug('%r Sending item seq=%d url=%s', self,
             item_doc['sequence'], item_doc['url'])
-        message = ServerMessage()
+        # The message is serialized before the next one is made, so a single
+        # instance is reused for every item.
+        message = self._item_message
+        message.Clear()
         message.event.subscription_id = self._id
 
         item = message.event.sync_item.item
@@ -295,7 +416,7 @@ class CrawlSyncSubscription:
         item.cost = item_doc['cost']
         item.duration = item_doc['duration']
         item.is_success = item_doc['is_success']
-        item.job_id = UUID(item_doc['job_id']).bytes
+        item.job_id = self._job_id_bytes
         item.started_at = item_doc['started_at'].isoformat()
         item.url = item_doc['url']
         item.url_can = item_doc['url_can']
@@ -303,31 +424,25 @@ class CrawlSyncSubscription:
         if 'exception' in item_doc:
             item.exception = item_doc['exception']
         else:
-            if item_doc['join']['is_compressed'] and not self._compression_ok:
-                body = gzip.decompress(item_doc['join']['body'])
-                is_compressed = False
-            else:
-                body = item_doc['join']['body']
-                is_compressed = item_doc['join']['is_compressed']
-            item.body = body
-            item.is_compressed = is_compressed
+            # If the client can't handle compression, then the body was
+            # already decompressed in _decompress_body().
+            item.body = item_doc['join']['body']
+            item.is_compressed = item_doc['join']['is_compressed']
             item.content_type = item_doc['content_type']
+            # Headers are stored as a flat list: [key1, value1, key2, ...]
             header_iter = iter(item_doc.get('headers', []))
-            for key in header_iter:
-                value = next(header_iter)
-                header = item.headers.add()
-                header.key = key
-                header.value = value
+            for key, value in zip(header_iter, header_iter):
+                item.headers.add(key=key, value=value)
             item.status_code = item_doc['status_code']
 
         message.event.sync_item.token = SyncTokenInt.encode(
             item_doc['sequence'])
-        await self._websocket.send_message(message.SerializeToString())
+        return message
 
     async def _set_initial_job_status(self):
         ''' Query database for initial job status and update internal state. '''
         run_state = await self._db.get_job_run_state(self._job_id)
-        logging.debug('%r Initial job state: %s', self, run_state)
+        logger.debug('%r Initial job state: %s', self, run_state)
         self._job_completed = run_state in FINISHED_STATES
 
 
@@ -399,37 +514,38 @@ class JobStatusSubscription:
         message.event.subscription_id = self._id
         current_send = dict()
 
+        jobs = message.event.job_list.jobs
+        last_send = self._last_send
+
         for job in self._stats_tracker.snapshot():
             job_id = job['id']
             current_send[job_id] = job
-            if job == self._last_send.get(job_id):
+            if job == last_send.get(job_id):
                 # No change since last send. Ignore this job.
                 continue
-            pb_job = message.event.job_list.jobs.add()
-            pb_job.job_id = UUID(job_id).bytes
-            pb_job.name = job['name']
-            pb_job.item_count = job['item_count']
-            pb_job.http_success_count = job['http_success_count']
-            pb_job.http_error_count = job['http_error_count']
-            pb_job.exception_count = job['exception_count']
-            for seed in job['seeds']:
-                pb_job.seeds.append(seed)
-            for tag in job['tags']:
-                pb_job.tags.append(tag)
-            pb_job.started_at = job['started_at'].isoformat()
+            pb_job = jobs.add(
+                job_id=job_id_to_bytes(job_id),
+                name=job['name'],
+                item_count=job['item_count'],
+                http_success_count=job['http_success_count'],
+                http_error_count=job['http_error_count'],
+                exception_count=job['exception_count'],
+                seeds=job['seeds'],
+                tags=job['tags'],
+                started_at=job['started_at'].isoformat(),
+                run_state=RUN_STATE_VALUES[job['run_state']],
+            )
             if job['completed_at']:
                 pb_job.completed_at = job['completed_at'].isoformat()
-            pb_job.run_state = JobRunState.Value(job['run_state'].upper())
             for status_code, count in job['http_status_counts'].items():
                 pb_job.http_status_counts[int(status_code)] = count
 
         # If there are jobs in the last send that are not in the current send,
         # then those are jobs which have been deleted. Send a delete event.
-        for job_id in self._last_send:
+        for job_id in last_send:
             if job_id not in current_send:
-                pb_job = message.event.job_list.jobs.add()
-                pb_job.job_id = UUID(job_id).bytes
-                pb_job.run_state = JobRunState.Value('DELETED')
+                jobs.add(job_id=job_id_to_bytes(job_id),
+                    run_state=RUN_STATE_VALUES['DELETED'])
 
         self._last_send = current_send
         return message
@@ -520,7 +636,7 @@ class ResourceMonitorSubscription:
 
         for job_measure in measurement['jobs']:
             job = frame.jobs.add()
-            job.job_id = UUID(job_measure['id']).bytes
+            job.job_id = job_id_to_bytes(job_measure['id'])
             job.name = job_measure['name']
             job.current_downloads = job_measure['current_downloads']
 
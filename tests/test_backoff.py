@@ -1,3 +1,5 @@
+import trio
+
 from . import assert_elapsed
 from starbelly.backoff import ExponentialBackoff
 
@@ -46,3 +48,24 @@ async def test_backoff_returns_value(autojump_clock):
     assert await backoff.__anext__() == 1
     backoff.decrease()
     assert await backoff.__anext__() == 1
+
+
+async def test_backoff_wake(autojump_clock, nursery):
+    ''' Waking the backoff ends the current delay early. '''
+    backoff = ExponentialBackoff(min_=8, max_=8)
+    assert await backoff.__anext__() == 0
+
+    async def wake_soon():
+        await trio.sleep(1)
+        backoff.wake()
+
+    nursery.start_soon(wake_soon)
+    with assert_elapsed(1):
+        assert await backoff.__anext__() == 8
+
+    # Waking while not waiting skips the next delay.
+    backoff.wake()
+    with assert_elapsed(0):
+        assert await backoff.__anext__() == 8
+    with assert_elapsed(8):
+        assert await backoff.__anext__() == 8
@@ -4,13 +4,15 @@ from functools import partial
 from unittest.mock import Mock
 
 from aiohttp import CookieJar
+import lxml.html
+import pytest
 import trio
 from yarl import URL
 
-from . import asyncio_loop, AsyncMock
+from . import asyncio_loop, assert_max_elapsed, AsyncMock
 from starbelly.captcha import CaptchaSolver
 from starbelly.downloader import Downloader, DownloadResponse
-from starbelly.login import LoginManager
+from starbelly.login import get_captcha_image_element, LoginManager
 from starbelly.policy import Policy
 
 
@@ -62,6 +64,21 @@ def make_policy(captcha_port=80):
     return Policy(policy_doc, '1.0.0', ['https://login.example'])
 
 
+def test_captcha_image_closest_to_field():
+    form = lxml.html.fromstring(
+    '''<form action="/login" method="POST">
+        <img src="/logo.png" alt="Logo">
+        <input type="text" name="username">
+        <input type="password" name="password">
+        <img src="/get-captcha" alt="CAPTCHA">
+        <input type="text" name="captcha">
+        <input type="submit" value="Log In">
+    </form>''')
+    assert get_captcha_image_element(form).get('src') == '/logo.png'
+    img_el = get_captcha_image_element(form, 'captcha')
+    assert img_el.get('src') == '/get-captcha'
+
+
 async def test_login_form():
     job_id = 'aaaaaaaa-aaaa-aaaa-aaaa-aaaaaaaaaaaa'
     db = Mock()
@@ -231,3 +248,59 @@ async def test_login_with_captcha(asyncio_loop, mocker, nursery):
     assert request.form_data['username'] == 'john'
     assert request.form_data['password'] == 'fake'
     assert request.form_data['captcha'] == 'ABCD1234'
+
+
+async def serve_captcha_api(nursery, poll_statuses):
+    '''
+    Start a fake CAPTCHA API that answers each poll with the next status in
+    ``poll_statuses`` (repeating the last one).
+
+    :returns: The server port and a list that records each poll request.
+    '''
+    polls = list()
+    async def handler(stream):
+        request = await stream.receive_some(4096)
+        if request.startswith(b'POST /createTask HTTP/1.1\r\n'):
+            body = b'{"errorId": 0, "taskId": 28278116}'
+        else:
+            assert request.startswith(b'POST /getTaskResult HTTP/1.1\r\n')
+            status = poll_statuses[min(len(polls), len(poll_statuses) - 1)]
+            polls.append(request)
+            if status == 'ready':
+                body = (b'{"errorId": 0, "taskId": 28278116, "status": "ready",'
+                    b' "solution": {"text": "ABCD1234"}}')
+            else:
+                body = b'{"errorId": 0, "status": "processing"}'
+        await stream.send_all(
+            b'HTTP/1.1 200 OK\r\n'
+            b'Content-type: application/json\r\n'
+            b'\r\n' + body + b'\r\n'
+        )
+    serve_tcp = partial(trio.serve_tcp, handler, port=0, host='127.0.0.1')
+    http_server = await nursery.start(serve_tcp)
+    addr, port = http_server[0].socket.getsockname()
+    return port, polls
+
+
+async def test_captcha_poll_until_ready(asyncio_loop, mocker, nursery):
+    port, polls = await serve_captcha_api(nursery, ['processing', 'ready'])
+    sleep_mock = mocker.patch('asyncio.sleep', new=AsyncMock())
+    login_manager = LoginManager('aaaaaaaa-aaaa-aaaa-aaaa-aaaaaaaaaaaa',
+        Mock(), make_policy(port), Mock())
+    solution = await login_manager._solve_captcha_asyncio(b'fake image')
+    assert solution == 'ABCD1234'
+    assert len(polls) == 2
+    assert sleep_mock.call_count == 2
+
+
+async def test_captcha_poll_gives_up(asyncio_loop, mocker, nursery):
+    # The first poll interval is longer than the budget, so the sleep must be
+    # cut short at the deadline rather than overrunning it.
+    port, polls = await serve_captcha_api(nursery, ['processing'])
+    mocker.patch('starbelly.login.CAPTCHA_POLL_BUDGET', 0.2)
+    login_manager = LoginManager('aaaaaaaa-aaaa-aaaa-aaaa-aaaaaaaaaaaa',
+        Mock(), make_policy(port), Mock())
+    with assert_max_elapsed(1), \
+         pytest.raises(Exception, match='CAPTCHA API never completed task'):
+        await login_manager._solve_captcha_asyncio(b'fake image')
+    assert len(polls) == 1
@@ -1,5 +1,7 @@
 from datetime import datetime, timedelta, timezone
 from functools import partial
+import gzip
+import os
 from unittest.mock import Mock
 from uuid import UUID
 
@@ -8,10 +10,16 @@ import trio
 import trio.hazmat
 from trio_websocket import open_websocket, serve_websocket
 
-from . import assert_elapsed, assert_max_elapsed, assert_min_elapsed
+from . import (
+    assert_elapsed,
+    assert_max_elapsed,
+    assert_min_elapsed,
+    AsyncMock,
+)
 from starbelly.job import StatsTracker
 from starbelly.starbelly_pb2 import JobRunState, ServerMessage
 from starbelly.subscription import (
+    CrawlSyncSubscription,
     ExponentialBackoff,
     JobStatusSubscription,
     ResourceMonitorSubscription,
@@ -55,6 +63,176 @@ def test_decode_malformed():
         assert SyncTokenInt.decode(token)
 
 
+class MockSubscriptionDb:
+    ''' A mock database layer that serves crawl sync items from a list. '''
+    def __init__(self, items, run_state):
+        self.items = items
+        self.get_job_run_state = AsyncMock(return_value=run_state)
+
+    async def get_job_sync_items(self, job_id, starting_sequence):
+        # Like the real query, only return items after the starting sequence,
+        # and don't see items that are added while a query is running.
+        for item in list(self.items):
+            if item['job_id'] == job_id and \
+                    item['sequence'] > starting_sequence:
+                yield item
+
+
+def make_sync_item(job_id, sequence, body, is_compressed):
+    return {
+        'sequence': sequence,
+        'job_id': job_id,
+        'url': 'https://sync.example/{}'.format(sequence),
+        'url_can': 'https://sync.example/{}'.format(sequence),
+        'started_at': datetime(2019, 2, 1, 10, 2, 0, tzinfo=timezone.utc),
+        'completed_at': datetime(2019, 2, 1, 10, 2, 1, tzinfo=timezone.utc),
+        'duration': 1.0,
+        'cost': 1.0,
+        'content_type': 'text/plain',
+        'status_code': 200,
+        'is_success': True,
+        'headers': ['CONTENT-TYPE', 'text/plain'],
+        'join': {
+            'body': gzip.compress(body) if is_compressed else body,
+            'is_compressed': is_compressed,
+        },
+    }
+
+
+async def test_crawl_sync_decompresses_bodies(nursery):
+    ''' If the client does not accept compression, then compressed bodies are
+    decompressed before they are sent. This test doesn't use autojump_clock,
+    because the clock would jump ahead if a worker thread were running. '''
+    job_id = 'aaaaaaaa-aaaa-aaaa-aaaa-aaaaaaaaaaaa'
+    db = MockSubscriptionDb([
+        make_sync_item(job_id, 1, b'Compressed body', is_compressed=True),
+        make_sync_item(job_id, 2, b'Plain body', is_compressed=False),
+    ], run_state='completed')
+    websocket = MockWebsocket()
+    _, job_state_recv = trio.open_memory_channel(0)
+    subscription = CrawlSyncSubscription(id_=1, websocket=websocket,
+        job_id=job_id, subscription_db=db, compression_ok=False,
+        job_state_recv=job_state_recv)
+    nursery.start_soon(subscription.run)
+
+    with assert_max_elapsed(1):
+        item1 = ServerMessage.FromString(await websocket.get_message()) \
+            .event.sync_item
+        assert item1.item.body == b'Compressed body'
+        assert not item1.item.is_compressed
+        assert item1.item.headers[0].key == 'CONTENT-TYPE'
+        assert item1.item.headers[0].value == 'text/plain'
+        assert SyncTokenInt.decode(item1.token) == 1
+
+        item2 = ServerMessage.FromString(await websocket.get_message()) \
+            .event.sync_item
+        assert item2.item.body == b'Plain body'
+        assert not item2.item.is_compressed
+        assert SyncTokenInt.decode(item2.token) == 2
+
+        event = ServerMessage.FromString(await websocket.get_message()).event
+        assert event.HasField('subscription_closed')
+
+
+async def test_crawl_sync_decompresses_large_bodies_in_thread(autojump_clock,
+        mocker, nursery):
+    ''' Small bodies are decompressed inline and large bodies are decompressed
+    in a worker thread. '''
+    async def run_sync(fn, *args):
+        return fn(*args)
+    thread_mock = mocker.patch('trio.run_sync_in_worker_thread',
+        new=AsyncMock(side_effect=run_sync))
+    mocker.patch('starbelly.subscription.SYNC_DECOMPRESS_THREAD_SIZE', 1024)
+    job_id = 'aaaaaaaa-aaaa-aaaa-aaaa-aaaaaaaaaaaa'
+    large_body = os.urandom(2048)
+    large_item = make_sync_item(job_id, 2, large_body, is_compressed=True)
+    large_compressed = large_item['join']['body']
+    db = MockSubscriptionDb([
+        make_sync_item(job_id, 1, b'Small body', is_compressed=True),
+        large_item,
+    ], run_state='completed')
+    websocket = MockWebsocket()
+    _, job_state_recv = trio.open_memory_channel(0)
+    subscription = CrawlSyncSubscription(id_=1, websocket=websocket,
+        job_id=job_id, subscription_db=db, compression_ok=False,
+        job_state_recv=job_state_recv)
+    nursery.start_soon(subscription.run)
+
+    with assert_max_elapsed(1):
+        item1 = ServerMessage.FromString(await websocket.get_message()) \
+            .event.sync_item
+        assert item1.item.body == b'Small body'
+        assert not item1.item.is_compressed
+        assert thread_mock.call_count == 0
+
+        item2 = ServerMessage.FromString(await websocket.get_message()) \
+            .event.sync_item
+        assert item2.item.body == large_body
+        assert not item2.item.is_compressed
+        assert thread_mock.call_count == 1
+        assert thread_mock.call_args == (gzip.decompress, large_compressed)
+
+
+async def test_crawl_sync_resumes_after_last_item(autojump_clock, nursery):
+    ''' Each poll pass resumes after the last item sent, so no item is skipped
+    or repeated at the boundary between passes. '''
+    job_id = 'aaaaaaaa-aaaa-aaaa-aaaa-aaaaaaaaaaaa'
+    db = MockSubscriptionDb([
+        make_sync_item(job_id, 1, b'Body 1', is_compressed=False),
+    ], run_state='running')
+    websocket = MockWebsocket()
+    job_state_send, job_state_recv = trio.open_memory_channel(0)
+    subscription = CrawlSyncSubscription(id_=1, websocket=websocket,
+        job_id=job_id, subscription_db=db, compression_ok=True,
+        job_state_recv=job_state_recv)
+    nursery.start_soon(subscription.run)
+
+    with assert_max_elapsed(1):
+        item1 = ServerMessage.FromString(await websocket.get_message()) \
+            .event.sync_item
+        assert SyncTokenInt.decode(item1.token) == 1
+
+    # Add more items, then finish the job, which wakes up the sync loop for a
+    # second pass.
+    db.items.append(make_sync_item(job_id, 2, b'Body 2', is_compressed=False))
+    db.items.append(make_sync_item(job_id, 3, b'Body 3', is_compressed=False))
+    await job_state_send.send(Mock(job_id=job_id, run_state='completed'))
+
+    with assert_max_elapsed(1):
+        item2 = ServerMessage.FromString(await websocket.get_message()) \
+            .event.sync_item
+        assert item2.item.body == b'Body 2'
+        assert SyncTokenInt.decode(item2.token) == 2
+
+        item3 = ServerMessage.FromString(await websocket.get_message()) \
+            .event.sync_item
+        assert item3.item.body == b'Body 3'
+        assert SyncTokenInt.decode(item3.token) == 3
+
+        event = ServerMessage.FromString(await websocket.get_message()).event
+        assert event.HasField('subscription_closed')
+
+
+async def test_crawl_sync_keeps_compressed_bodies(autojump_clock, nursery):
+    ''' If the client accepts compression, then bodies are sent as is. '''
+    job_id = 'aaaaaaaa-aaaa-aaaa-aaaa-aaaaaaaaaaaa'
+    db = MockSubscriptionDb([
+        make_sync_item(job_id, 1, b'Compressed body', is_compressed=True),
+    ], run_state='completed')
+    websocket = MockWebsocket()
+    _, job_state_recv = trio.open_memory_channel(0)
+    subscription = CrawlSyncSubscription(id_=1, websocket=websocket,
+        job_id=job_id, subscription_db=db, compression_ok=True,
+        job_state_recv=job_state_recv)
+    nursery.start_soon(subscription.run)
+
+    with assert_max_elapsed(1):
+        item1 = ServerMessage.FromString(await websocket.get_message()) \
+            .event.sync_item
+        assert item1.item.is_compressed
+        assert gzip.decompress(item1.item.body) == b'Compressed body'
+
+
 async def test_job_state_subscription(autojump_clock, nursery):
     job1_id = UUID('aaaaaaaa-aaaa-aaaa-aaaa-aaaaaaaaaaaa')
     job2_id = UUID('bbbbbbbb-bbbb-bbbb-bbbb-bbbbbbbbbbbb')